@@ -2,10 +2,25 @@
 Utility functions for running scripts. Exports:
 
 run_in_directory: Run a command in a directory.
+AdaptiveLauncher: Run commands in directories, adapting the number of
+concurrently running commands to system load and memory pressure.
+read_available_memory: Return the fraction of memory currently available.
+read_pressure: Return the highest current PSI "some avg10" value.
 """
 
+import logging
+import multiprocessing
 import os
 import subprocess
+import time
+
+import ordutils.log
+
+MEMINFO_FILE = "/proc/meminfo"
+PRESSURE_DIR = "/proc/pressure"
+PRESSURE_RESOURCES = ["cpu", "memory", "io"]
+PSI_ADJUST_INTERVAL = 10.0
+LOAD_ADJUST_INTERVAL = 60.0
 
 
 def run_in_directory(run_dir, command, cl_args=None, nohup=True):
@@ -13,7 +28,8 @@ def run_in_directory(run_dir, command, cl_args=None, nohup=True):
     Run a command in the specified directory.
 
     Run a command in the specified directory. Unlike subprocess.Popen(), the
-    command's path can be specified relative to the run directory.
+    command's path can be specified relative to the run directory. Returns the
+    subprocess.Popen object for the launched command.
     run_dir: the directory in which to run the command.
     command: the command or script to run.
     cl_args: a list of command line cl_args for the command.
@@ -26,5 +42,293 @@ def run_in_directory(run_dir, command, cl_args=None, nohup=True):
         args = args + cl_args
     if nohup:
         args = ['nohup'] + args
-    subprocess.Popen(args)
-    os.chdir(cwd)
+    try:
+        return subprocess.Popen(args)
+    finally:
+        os.chdir(cwd)
+
+
+class AdaptiveLauncher(object):
+    """
+    Run commands in directories with an adaptive concurrency limit.
+
+    Commands are launched as by run_in_directory(), but no more than the
+    current job limit are allowed to run at once. The limit is raised while
+    the system is lightly loaded and lowered when it comes under pressure, as
+    judged by the one-minute load average per CPU, the fraction of memory
+    available according to /proc/meminfo and, when present, the "some avg10"
+    values of the Linux PSI files in /proc/pressure. Each signal has a high
+    and a low threshold. While any signal is beyond its high-pressure
+    threshold new commands are held back, except that up to 'min_jobs'
+    commands are always allowed to run unless memory is short. Every change
+    to the limit is logged.
+
+    The limit is lowered by at most one step, to no more than the number of
+    commands running, per 'adjust_interval' seconds, and is only raised once
+    every signal is back beyond its low-pressure threshold and the limit has
+    not changed for 'adjust_interval' seconds. When PSI files are present,
+    raises are gated on the PSI ten-second average rather than on the
+    slow-moving one-minute load average, and 'adjust_interval' defaults to
+    PSI_ADJUST_INTERVAL seconds. Otherwise it defaults to LOAD_ADJUST_INTERVAL
+    seconds, close to the load average window, so that the limit does not
+    react again before the effect of the previous change shows up.
+
+    The default load thresholds straddle one runnable task per CPU: a node
+    running one CPU-bound command per CPU sits at a load of about 1.0 per
+    CPU, so 'load_high' is set well above that to let the limit settle at
+    'max_jobs' rather than collapsing, while 'load_low' is just below it.
+    """
+
+    def __init__(self, max_jobs=None, min_jobs=1, initial_jobs=None,
+                 load_high=1.5, load_low=0.9,
+                 memory_low=0.1, memory_high=0.2,
+                 pressure_high=10.0, pressure_low=2.0,
+                 poll_interval=1.0, adjust_interval=None, logger=None,
+                 meminfo_file=MEMINFO_FILE, pressure_dir=PRESSURE_DIR):
+        """
+        Create a launcher with the specified limits and thresholds.
+
+        If 'max_jobs' is less than one, 'min_jobs' is less than one or greater
+        than 'max_jobs', or any pair of thresholds is inverted, a ValueError
+        is raised.
+
+        max_jobs: Upper bound on the job limit; defaults to the number of CPUs.
+        min_jobs: Lower bound on the job limit, and the number of commands
+        allowed to run under load or PSI pressure.
+        initial_jobs: Starting job limit; defaults to half of 'max_jobs'.
+        load_high, load_low: One-minute load average per CPU above which the
+        limit is lowered, and below which it may be raised.
+        memory_low, memory_high: Fraction of memory available below which the
+        limit is lowered and no commands are launched, and above which it may
+        be raised.
+        pressure_high, pressure_low: PSI "some avg10" percentage above which
+        the limit is lowered, and below which it may be raised.
+        poll_interval: Seconds to sleep between checks while waiting for jobs.
+        adjust_interval: Minimum number of seconds between successive lowerings
+        of the limit, and after any change before it may be raised; defaults
+        depend on whether PSI files exist.
+        logger: Logger to which limit changes are written; defaults to the
+        logger configured by ordutils.log.get_logger().
+        meminfo_file: Path of the file from which memory usage is read.
+        pressure_dir: Path of the directory containing PSI files.
+        """
+        self.cpus = multiprocessing.cpu_count()
+        self.max_jobs = max_jobs if max_jobs is not None else self.cpus
+        if self.max_jobs < 1:
+            raise ValueError(
+                "Maximum number of jobs must be at least 1: '{m}'.".format(
+                    m=self.max_jobs))
+        if min_jobs < 1 or min_jobs > self.max_jobs:
+            raise ValueError(
+                "Minimum number of jobs must be between 1 and {m}: "
+                "'{n}'.".format(m=self.max_jobs, n=min_jobs))
+        for name, low, high in [("load", load_low, load_high),
+                                ("memory", memory_low, memory_high),
+                                ("pressure", pressure_low, pressure_high)]:
+            if low > high:
+                raise ValueError(
+                    "Inverted {n} thresholds: low '{l}' exceeds high "
+                    "'{h}'.".format(n=name, l=low, h=high))
+
+        self.min_jobs = min_jobs
+        if initial_jobs is None:
+            initial_jobs = self.max_jobs // 2
+        self.limit = max(self.min_jobs, min(initial_jobs, self.max_jobs))
+
+        self.load_high = load_high
+        self.load_low = load_low
+        self.memory_low = memory_low
+        self.memory_high = memory_high
+        self.pressure_high = pressure_high
+        self.pressure_low = pressure_low
+
+        self.poll_interval = poll_interval
+        self.adjust_interval = adjust_interval
+        self.logger = logger if logger is not None else \
+            logging.getLogger(ordutils.log.__name__)
+        self.meminfo_file = meminfo_file
+        self.pressure_dir = pressure_dir
+
+        self.processes = []
+        self.last_adjusted = None
+        self.last_lowered = None
+        self.last_held = None
+        self.overloaded = False
+        self.memory_short = False
+        self.have_pressure = False
+
+    def run_in_directory(self, run_dir, command, cl_args=None, nohup=True):
+        """
+        Run a command in the specified directory once a job slot is free.
+
+        Block until a command may be launched, then launch it as
+        run_in_directory() does and return its subprocess.Popen object. A
+        command may be launched if fewer than the current job limit of
+        commands launched by this object are running and the system is not
+        under pressure, or if fewer than 'min_jobs' are running and memory is
+        not short. Arguments are as for run_in_directory().
+        """
+        while True:
+            self.adjust_limit()
+            running = self.running_jobs()
+            if self.overloaded:
+                if running < self.min_jobs and not self.memory_short:
+                    break
+                self._log_held_back(running)
+            elif running < self.limit:
+                break
+            time.sleep(self.poll_interval)
+
+        self.last_held = None
+        process = run_in_directory(run_dir, command, cl_args, nohup)
+        self.processes.append(process)
+        return process
+
+    def wait(self):
+        """
+        Block until all commands launched by this object have finished.
+        """
+        while self.running_jobs() > 0:
+            time.sleep(self.poll_interval)
+
+    def running_jobs(self):
+        """
+        Return the number of commands launched by this object still running.
+        """
+        self.processes = [p for p in self.processes if p.poll() is None]
+        return len(self.processes)
+
+    def adjust_limit(self):
+        """
+        Raise or lower the job limit according to current system signals.
+
+        If any signal is beyond its high-pressure threshold, the launcher is
+        marked as overloaded and, unless the limit was lowered in the last
+        'adjust_interval' seconds, the limit is lowered to at most one less
+        than its current value and no more than the number of commands running
+        (but not below 'min_jobs'). The limit is raised by one if every signal
+        is beyond its low-pressure threshold, all job slots are in use, and
+        the limit has not changed in the last 'adjust_interval' seconds; when
+        PSI files are present, PSI rather than load average decides whether
+        the limit may be raised. Otherwise it is left unchanged. Returns the
+        (possibly new) job limit.
+        """
+        load = os.getloadavg()[0] / self.cpus
+        memory = read_available_memory(self.meminfo_file)
+        pressure = read_pressure(self.pressure_dir)
+        self.have_pressure = pressure is not None
+
+        self.memory_short = memory is not None and memory < self.memory_low
+        self.overloaded = load > self.load_high or self.memory_short or \
+            (pressure is not None and pressure > self.pressure_high)
+        underloaded = (memory is None or memory > self.memory_high) and \
+            (pressure < self.pressure_low if pressure is not None
+             else load < self.load_low)
+
+        running = self.running_jobs()
+        new_limit = self.limit
+        if self.overloaded:
+            if not self._lower_too_soon():
+                new_limit = max(self.min_jobs, min(self.limit - 1, running))
+        elif underloaded and running >= self.limit and \
+                not self._raise_too_soon():
+            new_limit = min(self.max_jobs, self.limit + 1)
+
+        if new_limit != self.limit:
+            self.logger.info(
+                "{change} job limit from {old} to {new} (load per CPU "
+                "{load:.2f}, memory available {memory}, pressure "
+                "{pressure}).".format(
+                    change="Raising" if new_limit > self.limit
+                    else "Lowering",
+                    old=self.limit, new=new_limit, load=load,
+                    memory=_format_signal(memory, "{:.1%}"),
+                    pressure=_format_signal(pressure, "{:.2f}%")))
+            self.last_adjusted = time.time()
+            if new_limit < self.limit:
+                self.last_lowered = self.last_adjusted
+            self.limit = new_limit
+
+        return self.limit
+
+    def _adjust_interval(self):
+        """Return the minimum number of seconds between limit changes."""
+        if self.adjust_interval is not None:
+            return self.adjust_interval
+        return PSI_ADJUST_INTERVAL if self.have_pressure \
+            else LOAD_ADJUST_INTERVAL
+
+    def _raise_too_soon(self):
+        """Return True if the limit changed too recently to be raised."""
+        return self.last_adjusted is not None and \
+            time.time() - self.last_adjusted < self._adjust_interval()
+
+    def _lower_too_soon(self):
+        """Return True if the limit was lowered too recently to lower again."""
+        return self.last_lowered is not None and \
+            time.time() - self.last_lowered < self._adjust_interval()
+
+    def _log_held_back(self, running):
+        """Log, at most once per adjust interval, that launches are held."""
+        now = time.time()
+        if self.last_held is not None and \
+                now - self.last_held < self._adjust_interval():
+            return
+        self.last_held = now
+        self.logger.debug(
+            "Holding back launch under {cause} with {running} job(s) "
+            "running.".format(
+                cause="memory shortage" if self.memory_short
+                else "system pressure",
+                running=running))
+
+
+def read_available_memory(meminfo_file=MEMINFO_FILE):
+    """
+    Return the fraction of memory currently available.
+
+    Return the ratio of the 'MemAvailable' to the 'MemTotal' values of a
+    /proc/meminfo-format file, or None if the file or either value is missing.
+    meminfo_file: Path of the file from which memory usage is read.
+    """
+    values = {}
+    try:
+        with open(meminfo_file) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2:
+                    values[fields[0].rstrip(":")] = int(fields[1])
+    except (IOError, OSError, ValueError):
+        return None
+
+    if not values.get("MemTotal") or "MemAvailable" not in values:
+        return None
+    return float(values["MemAvailable"]) / values["MemTotal"]
+
+
+def read_pressure(pressure_dir=PRESSURE_DIR):
+    """
+    Return the highest current PSI "some avg10" value, as a percentage.
+
+    Return the maximum "some avg10" value over the cpu, memory and io PSI files
+    present in the specified directory, or None if none of them can be read.
+    pressure_dir: Path of the directory containing PSI files.
+    """
+    pressures = []
+    for resource in PRESSURE_RESOURCES:
+        try:
+            with open(os.path.join(pressure_dir, resource)) as f:
+                for line in f:
+                    fields = line.split()
+                    if fields and fields[0] == "some":
+                        averages = dict(fld.split("=") for fld in fields[1:])
+                        pressures.append(float(averages["avg10"]))
+        except (IOError, OSError, KeyError, ValueError):
+            continue
+
+    return max(pressures) if pressures else None
+
+
+def _format_signal(value, fmt):
+    """Format a signal value for logging, or "n/a" if it is unavailable."""
+    return "n/a" if value is None else fmt.format(value)
@@ -1,8 +1,10 @@
+import logging
 import ordutils.process as ps
 import os.path
 import stat
 import time
 
+from pytest import raises
 from utils import temp_dir_created
 
 SCRIPT_NAME = "./script.sh"
@@ -39,3 +41,283 @@ def test_run_in_directory_include_command_line_args():
         ps.run_in_directory(dirname, "touch", [SCRIPT_NAME])
         time.sleep(0.1)
         assert os.path.exists(dirname + os.path.sep + SCRIPT_NAME)
+
+
+MEMINFO = "MemTotal: {total} kB\nMemFree: 100 kB\nMemAvailable: {avail} kB\n"
+PRESSURE = "some avg10={some:.2f} avg60=0.00 avg300=0.00 total=0\n" + \
+    "full avg10=0.00 avg60=0.00 avg300=0.00 total=0\n"
+
+
+def _write_meminfo(dirname, total, avail):
+    filename = os.path.join(dirname, "meminfo")
+    with open(filename, "w") as f:
+        f.write(MEMINFO.format(total=total, avail=avail))
+    return filename
+
+
+def _write_pressure(dirname, resource, some):
+    with open(os.path.join(dirname, resource), "w") as f:
+        f.write(PRESSURE.format(some=some))
+
+
+def _launcher(dirname, monkeypatch, load, **kwargs):
+    monkeypatch.setattr(os, "getloadavg", lambda: (load, load, load))
+    monkeypatch.setattr(ps.multiprocessing, "cpu_count", lambda: 4)
+    kwargs.setdefault("meminfo_file", os.path.join(dirname, "missing"))
+    kwargs.setdefault("pressure_dir", dirname)
+    return ps.AdaptiveLauncher(max_jobs=4, initial_jobs=2, adjust_interval=0,
+                               **kwargs)
+
+
+class _FakeProcess(object):
+    def poll(self):
+        return None
+
+
+class _CapturingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class _StopWaiting(Exception):
+    pass
+
+
+def _stop_waiting(seconds):
+    raise _StopWaiting()
+
+
+def test_read_available_memory_returns_fraction():
+    with temp_dir_created() as dirname:
+        meminfo = _write_meminfo(dirname, 1000, 250)
+        assert ps.read_available_memory(meminfo) == 0.25
+
+
+def test_read_available_memory_returns_none_if_file_missing():
+    with temp_dir_created() as dirname:
+        assert ps.read_available_memory(
+            os.path.join(dirname, "missing")) is None
+
+
+def test_read_pressure_returns_maximum_some_avg10():
+    with temp_dir_created() as dirname:
+        _write_pressure(dirname, "cpu", 1.5)
+        _write_pressure(dirname, "memory", 12.25)
+        assert ps.read_pressure(dirname) == 12.25
+
+
+def test_read_pressure_returns_none_if_files_missing():
+    with temp_dir_created() as dirname:
+        assert ps.read_pressure(dirname) is None
+
+
+def test_adaptive_launcher_lowers_limit_under_high_load(monkeypatch):
+    with temp_dir_created() as dirname:
+        launcher = _launcher(dirname, monkeypatch, load=8.0)
+        assert launcher.adjust_limit() == 1
+        assert launcher.adjust_limit() == 1
+
+
+def test_adaptive_launcher_lowers_limit_when_memory_low(monkeypatch):
+    with temp_dir_created() as dirname:
+        meminfo = _write_meminfo(dirname, 1000, 50)
+        launcher = _launcher(dirname, monkeypatch, load=0.0,
+                             meminfo_file=meminfo)
+        assert launcher.adjust_limit() == 1
+
+
+def test_adaptive_launcher_lowers_limit_under_high_pressure(monkeypatch):
+    with temp_dir_created() as dirname:
+        _write_pressure(dirname, "io", 50.0)
+        launcher = _launcher(dirname, monkeypatch, load=0.0)
+        assert launcher.adjust_limit() == 1
+
+
+def test_adaptive_launcher_raises_limit_only_when_slots_full(monkeypatch):
+    with temp_dir_created() as dirname:
+        launcher = _launcher(dirname, monkeypatch, load=0.0)
+        assert launcher.adjust_limit() == 2
+        launcher.processes = [_FakeProcess(), _FakeProcess()]
+        assert launcher.adjust_limit() == 3
+
+
+def test_adaptive_launcher_holds_limit_between_thresholds(monkeypatch):
+    with temp_dir_created() as dirname:
+        launcher = _launcher(dirname, monkeypatch, load=4.8)
+        launcher.processes = [_FakeProcess(), _FakeProcess()]
+        assert launcher.adjust_limit() == 2
+
+
+def test_adaptive_launcher_respects_adjust_interval(monkeypatch):
+    with temp_dir_created() as dirname:
+        launcher = _launcher(dirname, monkeypatch, load=8.0)
+        launcher.adjust_interval = 60
+        assert launcher.adjust_limit() == 1
+        monkeypatch.setattr(os, "getloadavg", lambda: (0.0, 0.0, 0.0))
+        launcher.processes = [_FakeProcess()]
+        assert launcher.adjust_limit() == 1
+
+
+def test_adaptive_launcher_runs_commands_in_directory(monkeypatch):
+    with temp_dir_created() as dirname:
+        launcher = _launcher(dirname, monkeypatch, load=0.0,
+                             poll_interval=0.01)
+        for i in range(3):
+            launcher.run_in_directory(dirname, "touch", ["out" + str(i)])
+        launcher.wait()
+        for i in range(3):
+            assert os.path.exists(os.path.join(dirname, "out" + str(i)))
+
+
+def test_adaptive_launcher_refuses_launch_when_memory_low(monkeypatch):
+    with temp_dir_created() as dirname:
+        meminfo = _write_meminfo(dirname, 1000, 20)
+        launcher = _launcher(dirname, monkeypatch, load=0.0,
+                             meminfo_file=meminfo)
+        launcher.limit = 4
+        launcher.processes = [_FakeProcess()]
+        monkeypatch.setattr(ps.time, "sleep", _stop_waiting)
+        with raises(_StopWaiting):
+            launcher.run_in_directory(dirname, "touch", ["out"])
+        assert launcher.limit == 1
+        assert len(launcher.processes) == 1
+        assert not os.path.exists(os.path.join(dirname, "out"))
+
+
+def test_adaptive_launcher_lowers_limit_within_adjust_interval(monkeypatch):
+    with temp_dir_created() as dirname:
+        launcher = _launcher(dirname, monkeypatch, load=0.0)
+        launcher.adjust_interval = 60
+        launcher.processes = [_FakeProcess(), _FakeProcess()]
+        assert launcher.adjust_limit() == 3
+        monkeypatch.setattr(os, "getloadavg", lambda: (8.0, 8.0, 8.0))
+        assert launcher.adjust_limit() == 2
+
+
+def test_adaptive_launcher_raises_limit_on_pressure_if_present(monkeypatch):
+    with temp_dir_created() as dirname:
+        _write_pressure(dirname, "cpu", 0.5)
+        launcher = _launcher(dirname, monkeypatch, load=4.8)
+        launcher.processes = [_FakeProcess(), _FakeProcess()]
+        assert launcher.adjust_limit() == 3
+
+
+def test_adaptive_launcher_rejects_max_jobs_below_one():
+    with raises(ValueError):
+        ps.AdaptiveLauncher(max_jobs=0)
+
+
+def test_adaptive_launcher_rejects_inverted_thresholds():
+    with raises(ValueError):
+        ps.AdaptiveLauncher(load_low=1.0, load_high=0.5)
+    with raises(ValueError):
+        ps.AdaptiveLauncher(memory_low=0.3, memory_high=0.2)
+    with raises(ValueError):
+        ps.AdaptiveLauncher(pressure_low=20.0, pressure_high=10.0)
+
+
+def test_adaptive_launcher_logs_each_limit_change(monkeypatch):
+    with temp_dir_created() as dirname:
+        handler = _CapturingHandler()
+        logger = logging.getLogger("test_adaptive_launcher")
+        logger.setLevel(logging.INFO)
+        logger.addHandler(handler)
+        launcher = _launcher(dirname, monkeypatch, load=0.0, logger=logger)
+
+        launcher.adjust_limit()
+        assert handler.messages == []
+
+        launcher.processes = [_FakeProcess(), _FakeProcess()]
+        launcher.adjust_limit()
+        assert len(handler.messages) == 1
+        assert handler.messages[0].startswith("Raising job limit from 2 to 3")
+
+        monkeypatch.setattr(os, "getloadavg", lambda: (8.0, 8.0, 8.0))
+        launcher.adjust_limit()
+        assert len(handler.messages) == 2
+        assert handler.messages[1].startswith("Lowering job limit from 3 to 2")
+
+        launcher.min_jobs = 2
+        launcher.adjust_limit()
+        assert len(handler.messages) == 2
+
+
+def test_adaptive_launcher_rejects_invalid_min_jobs():
+    with raises(ValueError):
+        ps.AdaptiveLauncher(max_jobs=4, min_jobs=0)
+    with raises(ValueError):
+        ps.AdaptiveLauncher(max_jobs=4, min_jobs=-1)
+    with raises(ValueError):
+        ps.AdaptiveLauncher(max_jobs=4, min_jobs=5)
+
+
+def test_adaptive_launcher_lowers_limit_once_per_interval(monkeypatch):
+    with temp_dir_created() as dirname:
+        launcher = _launcher(dirname, monkeypatch, load=8.0)
+        launcher.adjust_interval = None
+        launcher.limit = 4
+        launcher.processes = [_FakeProcess() for i in range(4)]
+        now = [1000.0]
+        monkeypatch.setattr(ps.time, "time", lambda: now[0])
+
+        assert launcher.adjust_limit() == 3
+        for i in range(59):
+            now[0] += 1
+            assert launcher.adjust_limit() == 3
+        now[0] += 1
+        assert launcher.adjust_limit() == 2
+
+
+def test_adaptive_launcher_launches_min_jobs_when_overloaded(monkeypatch):
+    with temp_dir_created() as dirname:
+        launcher = _launcher(dirname, monkeypatch, load=8.0)
+        monkeypatch.setattr(ps.time, "sleep", _stop_waiting)
+        launcher.run_in_directory(dirname, "touch", ["out"])
+        launcher.processes[0].wait()
+        assert os.path.exists(os.path.join(dirname, "out"))
+        launcher.processes = [_FakeProcess()]
+        with raises(_StopWaiting):
+            launcher.run_in_directory(dirname, "touch", ["out2"])
+
+
+def test_adaptive_launcher_refuses_min_jobs_when_memory_low(monkeypatch):
+    with temp_dir_created() as dirname:
+        meminfo = _write_meminfo(dirname, 1000, 20)
+        launcher = _launcher(dirname, monkeypatch, load=0.0,
+                             meminfo_file=meminfo)
+        monkeypatch.setattr(ps.time, "sleep", _stop_waiting)
+        with raises(_StopWaiting):
+            launcher.run_in_directory(dirname, "touch", ["out"])
+        assert launcher.processes == []
+
+
+def _check_default_raise_interval(dirname, monkeypatch, interval):
+    launcher = _launcher(dirname, monkeypatch, load=0.0)
+    launcher.adjust_interval = None
+    launcher.processes = [_FakeProcess(), _FakeProcess()]
+    now = [1000.0]
+    monkeypatch.setattr(ps.time, "time", lambda: now[0])
+
+    assert launcher.adjust_limit() == 3
+    launcher.processes.append(_FakeProcess())
+    now[0] += interval - 1
+    assert launcher.adjust_limit() == 3
+    now[0] += 1
+    assert launcher.adjust_limit() == 4
+
+
+def test_adaptive_launcher_holds_raises_for_psi_interval(monkeypatch):
+    with temp_dir_created() as dirname:
+        _write_pressure(dirname, "cpu", 0.5)
+        _check_default_raise_interval(
+            dirname, monkeypatch, ps.PSI_ADJUST_INTERVAL)
+
+
+def test_adaptive_launcher_holds_raises_for_load_interval(monkeypatch):
+    with temp_dir_created() as dirname:
+        _check_default_raise_interval(
+            dirname, monkeypatch, ps.LOAD_ADJUST_INTERVAL)